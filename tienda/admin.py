@@ -1,7 +1,15 @@
 import csv
+import hashlib
 from django.contrib import admin
-from django.http import HttpResponse
-from django.utils.html import format_html
+from django.contrib.postgres.search import SearchVectorField
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.http import StreamingHttpResponse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from sorl.thumbnail import get_thumbnail
 from .models import DisenoPersonalizado, Categoria, Producto, Pedido, DetallePedido
 
 # ==============================================================================
@@ -9,22 +17,67 @@ from .models import DisenoPersonalizado, Categoria, Producto, Pedido, DetallePed
 # Estas funciones se pueden aplicar a un conjunto de objetos seleccionados.
 # ==============================================================================
 
+class Echo:
+    """
+    Objeto con interfaz de archivo que devuelve lo que se le escribe, en lugar
+    de guardarlo. Permite a csv.writer generar las filas una a una.
+    """
+    def write(self, value):
+        return value
+
+
 @admin.action(description="Exportar seleccionados a CSV/Excel")
 def exportar_a_csv(modeladmin, request, queryset):
     """
     Acción que exporta los pedidos seleccionados a un archivo CSV.
+    Las filas se envían al navegador a medida que se generan (streaming),
+    así no se carga todo el archivo en memoria.
     """
     meta = modeladmin.model._meta
-    field_names = [field.name for field in meta.fields]
+    # El vector de búsqueda es un dato interno, no se exporta.
+    field_names = [field.name for field in meta.fields if not isinstance(field, SearchVectorField)]
+    writer = csv.writer(Echo())
 
-    response = HttpResponse(content_type='text/csv')
+    def generar_filas():
+        yield writer.writerow(field_names)
+        # iterator() lee de la base de datos por bloques en vez de cargar todo.
+        for obj in queryset.iterator(chunk_size=2000):
+            yield writer.writerow([getattr(obj, field) for field in field_names])
+
+    response = StreamingHttpResponse(generar_filas(), content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename={meta.verbose_name_plural}.csv'
-    writer = csv.writer(response)
+    return response
 
-    writer.writerow(field_names)
-    for obj in queryset:
-        row = writer.writerow([getattr(obj, field) for field in field_names])
 
+@admin.action(description="Exportar seleccionados a CSV (rápido)")
+def exportar_raw(modeladmin, request, queryset):
+    """
+    Igual que exportar_a_csv, pero lee las filas directamente del cursor de la
+    base de datos en bloques, sin crear un objeto del modelo por cada fila.
+    Las claves foráneas se exportan como su ID (ej: categoria_id).
+    """
+    meta = modeladmin.model._meta
+    # Igual que en exportar_a_csv, el vector de búsqueda no se exporta.
+    columnas = [
+        field.attname for field in meta.concrete_fields
+        if not isinstance(field, SearchVectorField)
+    ]
+    # El ORM solo se usa para generar el SELECT con los filtros de la selección.
+    sql, params = queryset.values_list(*columnas).query.sql_with_params()
+    writer = csv.writer(Echo())
+
+    def generar_filas():
+        yield writer.writerow(columnas)
+        # chunked_cursor usa un cursor del lado del servidor cuando la base de
+        # datos lo permite, así las filas llegan de 2000 en 2000.
+        with connections[queryset.db].chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            while filas := cursor.fetchmany(2000):
+                for fila in filas:
+                    yield writer.writerow(fila)
+
+    response = StreamingHttpResponse(generar_filas(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename={meta.verbose_name_plural}.csv'
     return response
 
 
@@ -44,6 +97,39 @@ def marcar_como_no_disponible(modeladmin, request, queryset):
     queryset.update(disponible=False)
 
 
+# ==============================================================================
+# PAGINADOR PARA TABLAS GRANDES
+# ==============================================================================
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginador que evita el SELECT COUNT(*) sobre tablas muy grandes.
+    - Sin filtros: usa la estimación de filas que guarda PostgreSQL (pg_class).
+    - Con filtros (o en otra base de datos): cuenta de verdad, pero guarda el
+      resultado 60 segundos en caché para no repetirlo al cambiar de página.
+    """
+    # Por debajo de este número de filas contar de verdad es barato y exacto.
+    MINIMO_ESTIMACION = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table]
+                )
+                fila = cursor.fetchone()
+            if fila and fila[0] >= self.MINIMO_ESTIMACION:
+                return fila[0]
+
+        clave = 'admin_count_' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+        return cache.get_or_set(clave, queryset.count, 60)
+
+
 # ==============================================================================
 # CONFIGURACIÓN DEL PANEL DE ADMINISTRADOR PARA CADA MODELO
 # ==============================================================================
@@ -80,19 +166,29 @@ class ProductoAdmin(admin.ModelAdmin):
     """
     list_display = ('imagen_tag', 'nombre', 'categoria', 'precio', 'stock', 'disponible')
     list_filter = ('categoria', 'disponible', 'fecha_ingreso')
-    search_fields = ('nombre', 'descripcion', 'categoria__nombre')
+    # Solo se busca por nombre: la descripción es un texto largo y buscar por
+    # categoría obligaba a un JOIN en cada búsqueda.
+    search_fields = ('nombre',)
+    # La categoría se elige con un buscador (usa CategoriaAdmin.search_fields).
+    autocomplete_fields = ('categoria',)
+    # Trae la categoría en la misma consulta para no hacer una por cada fila.
+    list_select_related = ('categoria',)
     
     # Permite editar estos campos directamente desde la lista, sin entrar al detalle.
     list_editable = ('precio', 'stock', 'disponible')
     
     # Acciones personalizadas que aparecerán en el menú desplegable "Acciones".
-    actions = [exportar_a_csv, marcar_como_disponible, marcar_como_no_disponible]
+    actions = [exportar_a_csv, exportar_raw, marcar_como_disponible, marcar_como_no_disponible]
 
-    # Campo para previsualizar la imagen en la lista de productos
+    # Campo para previsualizar la imagen en la lista de productos.
+    # Se usa una miniatura de 50x50 (generada una vez y guardada en caché)
+    # en lugar de la imagen original a tamaño completo.
     @admin.display(description='Imagen')
     def imagen_tag(self, obj):
         if obj.imagen:
-            return format_html('<img src="{}" width="50" height="50" style="object-fit: cover;" />', obj.imagen.url)
+            miniatura = get_thumbnail(obj.imagen, '50x50', crop='center', quality=70)
+            # Solo la URL es variable: se escapa una vez y se evita format_html.
+            return mark_safe(f'<img src="{escape(miniatura.url)}" width="50" height="50" style="object-fit: cover;" loading="lazy" />')
         return "No Imagen"
 
 
@@ -103,13 +199,20 @@ class DetallePedidoInline(admin.TabularInline):
     """
     model = DetallePedido
     extra = 0  # No mostrar filas vacías para añadir nuevos ítems.
-    readonly_fields = ('producto', 'cantidad', 'precio_unitario', 'subtotal')
+    readonly_fields = ('producto', 'cantidad', 'precio_unitario', 'subtotal_display')
     
     # Campo calculado para mostrar el subtotal de cada línea.
+    # El subtotal ya viene guardado en la fila (get_subtotal solo lo calcula
+    # en líneas antiguas que aún no lo tienen).
+    # No se llama "subtotal" porque el campo del modelo tendría prioridad.
     @admin.display(description='Subtotal')
-    def subtotal(self, obj):
+    def subtotal_display(self, obj):
         return f"${obj.get_subtotal()}"
 
+    # Trae el producto en la misma consulta para no hacer una por cada línea.
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('producto')
+
     # No permitir añadir o borrar detalles de un pedido ya creado desde el admin.
     def has_add_permission(self, request, obj=None):
         return False
@@ -126,7 +229,13 @@ class PedidoAdmin(admin.ModelAdmin):
     list_display = ('id', 'usuario', 'fecha_pedido', 'estado', 'total', 'id_transaccion_pago')
     list_filter = ('estado', 'fecha_pedido', 'usuario')
     search_fields = ('usuario__username', 'id', 'id_transaccion_pago')
+    # Trae el usuario en la misma consulta para no hacer una por cada fila.
+    list_select_related = ('usuario',)
     date_hierarchy = 'fecha_pedido'  # Añade una navegación por fechas en la parte superior.
+
+    # Evita contar toda la tabla de pedidos en cada página del listado.
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     
     # Los pedidos no se deberían poder crear o modificar libremente desde el admin.
     # Son generados por el sistema de pago. Solo se debería poder cambiar el estado.
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from tienda.models import Producto
+
+
+class Command(BaseCommand):
+    """
+    Recalcula el vector de búsqueda de todos los productos.
+    Hay que ejecutarlo una vez tras añadir el campo search_vector, y después de
+    cargas masivas (bulk_create / update) que no pasan por Producto.save().
+    """
+    help = "Rellena Producto.search_vector para la búsqueda del catálogo."
+
+    def handle(self, *args, **options):
+        total = Producto.objects.update(search_vector=Producto.VECTOR_BUSQUEDA)
+        self.stdout.write(self.style.SUCCESS(f"Vector de búsqueda actualizado en {total} productos."))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from tienda.models import DetallePedido
+
+
+class Command(BaseCommand):
+    """
+    Rellena el subtotal guardado de las líneas de pedido que no lo tienen.
+    Hay que ejecutarlo una vez tras añadir el campo DetallePedido.subtotal.
+    """
+    help = "Calcula DetallePedido.subtotal (cantidad x precio_unitario) en las líneas antiguas."
+
+    def handle(self, *args, **options):
+        total = DetallePedido.objects.filter(subtotal__isnull=True).update(
+            subtotal=F('cantidad') * F('precio_unitario')
+        )
+        self.stdout.write(self.style.SUCCESS(f"Subtotal actualizado en {total} líneas de pedido."))
@@ -1,5 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 # ==============================================================================
 # 1. MODELO PARA LA PERSONALIZACIÓN DEL DISEÑO
@@ -34,9 +39,22 @@ class DisenoPersonalizado(models.Model):
         help_text="Banner grande para la página de inicio (para promociones)."
     )
 
+    # Clave con la que se guarda la configuración en la caché (ver vista catalogo).
+    CACHE_KEY = 'diseno_personalizado'
+
     def __str__(self):
         return "Configuración de Diseño del Sitio"
 
+    # Al guardar o borrar se limpia la caché para que el sitio vea el cambio.
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        cache.delete(self.CACHE_KEY)
+
+    def delete(self, *args, **kwargs):
+        resultado = super().delete(*args, **kwargs)
+        cache.delete(self.CACHE_KEY)
+        return resultado
+
     class Meta:
         # Esto hace que en el panel de admin aparezca con un nombre más amigable.
         verbose_name = "1. Personalización de Diseño"
@@ -54,6 +72,9 @@ class Categoria(models.Model):
     nombre = models.CharField(max_length=100, unique=True)
     descripcion = models.TextField(blank=True, help_text="Descripción opcional de la categoría.")
 
+    # Clave con la que se guarda la lista de categorías en la caché (ver vista catalogo).
+    CACHE_KEY = 'all_categorias'
+
     def __str__(self):
         return self.nombre
 
@@ -62,6 +83,14 @@ class Categoria(models.Model):
         verbose_name_plural = "2. Categorías de Productos"
 
 
+# Se usan señales (y no save/delete) para cubrir también los borrados masivos
+# desde el admin, que no llaman a Categoria.delete().
+@receiver(post_save, sender=Categoria)
+@receiver(post_delete, sender=Categoria)
+def limpiar_cache_categorias(sender, **kwargs):
+    cache.delete(Categoria.CACHE_KEY)
+
+
 # ==============================================================================
 # 3. MODELO PARA LOS PRODUCTOS
 # El corazón de la tienda. Aquí se define cada artículo que se vende.
@@ -70,7 +99,7 @@ class Producto(models.Model):
     """
     Representa un artículo individual en el inventario del supermercado.
     """
-    nombre = models.CharField(max_length=200)
+    nombre = models.CharField(max_length=200, db_index=True)
     descripcion = models.TextField()
     precio = models.DecimalField(
         max_digits=10, 
@@ -92,20 +121,44 @@ class Producto(models.Model):
     )
     disponible = models.BooleanField(
         default=True, 
+        db_index=True,
         help_text="Marca si el producto está visible y se puede comprar."
     )
     fecha_ingreso = models.DateTimeField(
         auto_now_add=True, 
+        db_index=True,
         help_text="Fecha y hora en que se creó el producto en el sistema."
     )
+    # Texto de búsqueda ya procesado (nombre + descripción) para la búsqueda
+    # del catálogo. Se rellena solo al guardar, no se edita a mano.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # Expresión con la que Postgres calcula search_vector. Para rellenar los
+    # productos existentes (o tras un bulk_create/update): `manage.py actualizar_busqueda`.
+    VECTOR_BUSQUEDA = SearchVector('nombre', 'descripcion', config='spanish')
 
     def __str__(self):
         return f"{self.nombre} (${self.precio})"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Si solo se guardan otros campos (precio, stock...) el texto no cambió.
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'nombre', 'descripcion'} & set(update_fields):
+            return
+        # Postgres calcula el vector de búsqueda a partir de los campos guardados.
+        Producto.objects.filter(pk=self.pk).update(search_vector=self.VECTOR_BUSQUEDA)
+
     class Meta:
         ordering = ['nombre'] # Ordena los productos alfabéticamente por defecto.
         verbose_name = "Producto"
         verbose_name_plural = "3. Productos"
+        indexes = [
+            # Para la consulta más común: productos disponibles de una categoría.
+            models.Index(fields=['categoria', 'disponible']),
+            # Índice de texto completo para la búsqueda del catálogo.
+            GinIndex(fields=['search_vector']),
+        ]
 
 
 # ==============================================================================
@@ -127,11 +180,11 @@ class Pedido(models.Model):
     # on_delete=models.CASCADE significa que si un usuario es borrado,
     # todos sus pedidos también se borrarán.
     usuario = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pedidos')
-    fecha_pedido = models.DateTimeField(auto_now_add=True)
-    estado = models.CharField(max_length=20, choices=ESTADO_CHOICES, default='Pendiente')
+    fecha_pedido = models.DateTimeField(auto_now_add=True, db_index=True)
+    estado = models.CharField(max_length=20, choices=ESTADO_CHOICES, default='Pendiente', db_index=True)
     total = models.DecimalField(max_digits=10, decimal_places=2)
     direccion_envio = models.CharField(max_length=255, blank=True, help_text="Dirección de envío para este pedido.")
-    id_transaccion_pago = models.CharField(max_length=100, blank=True, help_text="ID de la transacción de la pasarela de pago (ej: Stripe).")
+    id_transaccion_pago = models.CharField(max_length=100, blank=True, db_index=True, help_text="ID de la transacción de la pasarela de pago (ej: Stripe).")
 
     def __str__(self):
         return f"Pedido #{self.id} de {self.usuario.username} - {self.estado}"
@@ -140,6 +193,19 @@ class Pedido(models.Model):
         ordering = ['-fecha_pedido'] # Los pedidos más recientes aparecerán primero.
         verbose_name = "Pedido"
         verbose_name_plural = "4. Pedidos"
+        indexes = [
+            # Para el historial de pedidos de un usuario, del más reciente al más antiguo.
+            models.Index(fields=['usuario', '-fecha_pedido']),
+        ]
+        constraints = [
+            # Un pago de Stripe solo puede generar un pedido. Se excluyen los
+            # pedidos sin ID de transacción (campo vacío) para que no choquen entre sí.
+            models.UniqueConstraint(
+                fields=['id_transaccion_pago'],
+                condition=~models.Q(id_transaccion_pago=''),
+                name='pedido_id_transaccion_pago_unico',
+            ),
+        ]
 
 
 # ==============================================================================
@@ -163,12 +229,23 @@ class DetallePedido(models.Model):
         decimal_places=2,
         help_text="Precio del producto en el momento de la compra."
     )
+    # Se guarda calculado (cantidad x precio_unitario) para no multiplicar en cada lectura.
+    # Es nulo en las líneas anteriores a este campo hasta que se ejecute
+    # `manage.py actualizar_subtotales`.
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, null=True, editable=False)
 
     def __str__(self):
-        return f"{self.cantidad} x {self.producto.nombre} en Pedido #{self.pedido.id}"
+        return f"{self.cantidad} x {self.producto.nombre} en Pedido #{self.pedido_id}"
 
     def get_subtotal(self):
-        return self.cantidad * self.precio_unitario
+        if self.subtotal is None:
+            return self.cantidad * self.precio_unitario
+        return self.subtotal
+
+    def save(self, *args, **kwargs):
+        # bulk_create no pasa por aquí: quien lo use debe rellenar el subtotal.
+        self.subtotal = self.cantidad * self.precio_unitario
+        super().save(*args, **kwargs)
 
     class Meta:
         # Asegura que no se pueda añadir el mismo producto dos veces en el mismo pedido.
@@ -176,3 +253,27 @@ class DetallePedido(models.Model):
         unique_together = ('pedido', 'producto')
         verbose_name = "Detalle de Pedido"
         verbose_name_plural = "Detalles de Pedidos"
+
+
+# ==============================================================================
+# 6. MODELO PARA LOS PEDIDOS PENDIENTES DE PAGO
+# Guarda el carrito en el servidor mientras el usuario paga en Stripe.
+# A Stripe solo se le envía el ID de esta fila (sus metadatos tienen un límite
+# de 500 caracteres por valor y un carrito grande no cabría).
+# ==============================================================================
+class PedidoPendiente(models.Model):
+    """
+    Carrito de un usuario que ha iniciado el pago y todavía no se ha confirmado.
+    El webhook de Stripe lo convierte en un Pedido y luego lo borra.
+    """
+    usuario = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pedidos_pendientes')
+    id_sesion_pago = models.CharField(max_length=255, blank=True, help_text="ID de la sesión de pago de Stripe.")
+    carrito = models.JSONField()
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Pedido pendiente #{self.id} de {self.usuario_id}"
+
+    class Meta:
+        verbose_name = "Pedido Pendiente"
+        verbose_name_plural = "Pedidos Pendientes"
@@ -1,17 +1,25 @@
 # Importaciones necesarias de Django y otras librerías
 import json
+from decimal import Decimal
 import stripe # Para la integración de pagos
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, Http404
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib import messages
+from django.contrib.auth.models import User
 from django.conf import settings
+from django.contrib.postgres.search import SearchQuery
+from django.core import signing
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Prefetch, Value, When
 from django.core.mail import send_mail
 
 # Importaciones de nuestros modelos
-from .models import Producto, Categoria, Pedido, DetallePedido, DisenoPersonalizado
+from .models import Producto, Categoria, Pedido, DetallePedido, DisenoPersonalizado, PedidoPendiente
 
 # ==============================================================================
 # VISTAS PÚBLICAS (Accesibles por todos los usuarios)
@@ -19,30 +27,42 @@ from .models import Producto, Categoria, Pedido, DetallePedido, DisenoPersonaliz
 
 def catalogo(request):
     """
-    Muestra la página principal con el catálogo de productos.
+    Muestra la página principal con el catálogo de productos, paginado.
     Permite filtrar por categoría y buscar por nombre.
     """
-    # Obtener el objeto de diseño para pasar colores, logo, etc., a la plantilla
-    try:
-        diseno = DisenoPersonalizado.objects.first()
-    except DisenoPersonalizado.DoesNotExist:
-        diseno = None
+    # Obtener el objeto de diseño para pasar colores, logo, etc., a la plantilla.
+    # Es una única fila que casi nunca cambia, así que se guarda en caché.
+    diseno = cache.get_or_set(
+        DisenoPersonalizado.CACHE_KEY,
+        lambda: DisenoPersonalizado.objects.first(),
+        timeout=3600
+    )
 
-    # Lógica de filtrado y búsqueda
-    productos = Producto.objects.filter(disponible=True)
-    categorias = Categoria.objects.all()
+    # Lógica de filtrado y búsqueda.
+    # El listado no muestra la descripción ni usa el vector de búsqueda, así que
+    # no se cargan; la categoría se trae en la misma consulta.
+    productos = Producto.objects.filter(disponible=True).defer(
+        'descripcion', 'search_vector'
+    ).select_related('categoria')
+    # Las categorías cambian muy poco: se guardan en caché como lista.
+    categorias = cache.get_or_set(Categoria.CACHE_KEY, lambda: list(Categoria.objects.all()), 600)
     
     query = request.GET.get('q')
     categoria_id = request.GET.get('categoria')
 
     if query:
-        productos = productos.filter(nombre__icontains=query)
+        # Búsqueda de texto completo en español (usa el índice GIN de search_vector).
+        productos = productos.filter(search_vector=SearchQuery(query, config='spanish'))
     
     if categoria_id:
         productos = productos.filter(categoria_id=categoria_id)
 
+    paginator = Paginator(productos, 24)
+    page_obj = paginator.get_page(request.GET.get('page'))
+
     context = {
-        'productos': productos,
+        'productos': page_obj,
+        'page_obj': page_obj,
         'categorias': categorias,
         'diseno': diseno,
         'selected_categoria': int(categoria_id) if categoria_id else None,
@@ -51,20 +71,95 @@ def catalogo(request):
 
 
 # ==============================================================================
-# VISTAS DEL CARRITO DE COMPRAS (Manejo de la sesión)
+# VISTAS DEL CARRITO DE COMPRAS (Manejo de una cookie firmada)
+# El carrito vive en una cookie firmada en vez de en la sesión, así no hace
+# falta leer la sesión de la base de datos en cada petición.
 # ==============================================================================
 
+CARRITO_COOKIE = 'carrito'
+CARRITO_SALT = 'tienda.carrito'
+# Los navegadores descartan sin avisar las cookies de más de ~4 KB.
+CARRITO_MAX_BYTES = 4000
+
+
+def leer_carrito(request):
+    """
+    Devuelve el carrito guardado en la cookie firmada, o uno vacío si no hay
+    cookie, la firma no es válida o ha caducado.
+    """
+    valor = request.COOKIES.get(CARRITO_COOKIE)
+    if not valor:
+        return {}
+    try:
+        return signing.loads(valor, salt=CARRITO_SALT, max_age=settings.SESSION_COOKIE_AGE)
+    except signing.BadSignature:
+        return {}
+
+
+def codificar_carrito(carrito):
+    """
+    Firma y comprime el carrito para guardarlo en la cookie.
+    """
+    return signing.dumps(carrito, salt=CARRITO_SALT, compress=True)
+
+
+def guardar_carrito(response, valor):
+    """
+    Guarda en la cookie de la respuesta el carrito ya codificado con codificar_carrito.
+    """
+    # Dura lo mismo que la sesión, donde antes se guardaba el carrito.
+    response.set_cookie(
+        CARRITO_COOKIE, valor,
+        max_age=settings.SESSION_COOKIE_AGE, secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True, samesite='Lax'
+    )
+    return response
+
+
+def actualizar_item_carrito(item, cantidad, precio=None):
+    """
+    Cambia la cantidad (y el precio, si se indica) de un ítem y recalcula su
+    total una sola vez. Los importes se guardan como texto para no perder
+    precisión en el JSON.
+    """
+    item['cantidad'] = cantidad
+    if precio is not None:
+        item['precio'] = str(precio)
+    item['total_item'] = str(Decimal(item['precio']) * cantidad)
+
+
+def obtener_productos_carrito(carrito):
+    """
+    Trae todos los productos del carrito en una sola consulta.
+    Devuelve un diccionario {id: Producto}. Lanza 404 si alguno ya no existe.
+    Solo se cargan los campos que usa el carrito (no la descripción).
+    """
+    ids = [int(producto_id) for producto_id in carrito]
+    productos = Producto.objects.only('id', 'nombre', 'precio', 'imagen', 'stock').in_bulk(ids)
+    if len(productos) != len(ids):
+        raise Http404("Uno de los productos del carrito ya no existe.")
+    return productos
+
+
 def vista_carrito(request):
     """
     Muestra el contenido del carrito de compras y calcula los totales.
     """
-    carrito = request.session.get('carrito', {})
+    carrito = leer_carrito(request)
     items_carrito = []
-    subtotal_carrito = 0
+    subtotal_carrito = Decimal('0')
+    productos = obtener_productos_carrito(carrito)
+    carrito_modificado = False
 
     for producto_id, item_data in carrito.items():
-        producto = get_object_or_404(Producto, id=producto_id)
-        total_item = producto.precio * item_data['cantidad']
+        producto = productos[int(producto_id)]
+        # Si el precio cambió desde que se añadió, se usa el actual: es el que
+        # se cobrará en Stripe (ver crear_sesion_pago).
+        if Decimal(item_data['precio']) != producto.precio:
+            actualizar_item_carrito(item_data, item_data['cantidad'], producto.precio)
+            carrito_modificado = True
+        # El total de cada ítem ya se calculó al modificar el carrito.
+        total_item = Decimal(item_data['total_item'])
         items_carrito.append({
             'producto': producto,
             'cantidad': item_data['cantidad'],
@@ -73,7 +168,7 @@ def vista_carrito(request):
         subtotal_carrito += total_item
     
     # Ejemplo de cálculo de impuesto (ej: 19%)
-    impuesto = subtotal_carrito * 0.19
+    impuesto = subtotal_carrito * Decimal('0.19')
     total_final = subtotal_carrito + impuesto
     
     context = {
@@ -83,7 +178,10 @@ def vista_carrito(request):
         'total_final': total_final,
         'stripe_public_key': settings.STRIPE_PUBLIC_KEY
     }
-    return render(request, 'tienda/carrito.html', context)
+    response = render(request, 'tienda/carrito.html', context)
+    if carrito_modificado:
+        guardar_carrito(response, codificar_carrito(carrito))
+    return response
 
 
 @require_POST
@@ -95,22 +193,27 @@ def agregar_al_carrito(request):
     producto_id = str(data.get('producto_id'))
     producto = get_object_or_404(Producto, id=producto_id)
     
-    carrito = request.session.get('carrito', {})
+    carrito = leer_carrito(request)
     
     if producto.stock <= 0:
         return JsonResponse({'error': 'Producto sin stock'}, status=400)
     
     if producto_id in carrito:
         if producto.stock > carrito[producto_id]['cantidad']:
-            carrito[producto_id]['cantidad'] += 1
+            actualizar_item_carrito(carrito[producto_id], carrito[producto_id]['cantidad'] + 1, producto.precio)
         else:
             return JsonResponse({'error': 'No hay suficiente stock'}, status=400)
     else:
-        carrito[producto_id] = {'cantidad': 1}
+        carrito[producto_id] = {}
+        actualizar_item_carrito(carrito[producto_id], 1, producto.precio)
         
-    request.session['carrito'] = carrito
+    valor = codificar_carrito(carrito)
+    if len(valor) > CARRITO_MAX_BYTES:
+        return JsonResponse({'error': 'El carrito está lleno, no se pueden añadir más productos distintos'}, status=400)
+
     messages.success(request, f'"{producto.nombre}" fue añadido a tu carrito.')
-    return JsonResponse({'mensaje': f'{producto.nombre} añadido al carrito.', 'total_items': sum(item['cantidad'] for item in carrito.values())})
+    response = JsonResponse({'mensaje': f'{producto.nombre} añadido al carrito.', 'total_items': sum(item['cantidad'] for item in carrito.values())})
+    return guardar_carrito(response, valor)
 
 
 @require_POST
@@ -122,16 +225,19 @@ def actualizar_carrito(request):
     producto_id = str(data.get('producto_id'))
     cantidad = int(data.get('cantidad'))
     
-    carrito = request.session.get('carrito', {})
+    carrito = leer_carrito(request)
     
     if producto_id in carrito:
         if cantidad > 0:
-            carrito[producto_id]['cantidad'] = cantidad
+            actualizar_item_carrito(carrito[producto_id], cantidad)
         else:
             del carrito[producto_id] # Eliminar si la cantidad es 0 o menos
+
+        valor = codificar_carrito(carrito)
+        if len(valor) > CARRITO_MAX_BYTES:
+            return JsonResponse({'error': 'El carrito está lleno'}, status=400)
         
-        request.session['carrito'] = carrito
-        return JsonResponse({'mensaje': 'Carrito actualizado.'})
+        return guardar_carrito(JsonResponse({'mensaje': 'Carrito actualizado.'}), valor)
     
     return JsonResponse({'error': 'Producto no encontrado en el carrito'}, status=404)
 
@@ -145,14 +251,15 @@ def crear_sesion_pago(request):
     """
     Crea una sesión de pago en Stripe y redirige al usuario a la pasarela de pago.
     """
-    carrito = request.session.get('carrito', {})
+    carrito = leer_carrito(request)
     if not carrito:
         messages.error(request, "Tu carrito está vacío.")
         return redirect('vista_carrito')
 
     line_items = []
+    productos = obtener_productos_carrito(carrito)
     for producto_id, item_data in carrito.items():
-        producto = get_object_or_404(Producto, id=producto_id)
+        producto = productos[int(producto_id)]
         line_items.append({
             'price_data': {
                 'currency': 'usd', # Cambiar a tu moneda local (ej: 'eur', 'mxn')
@@ -165,6 +272,10 @@ def crear_sesion_pago(request):
             'quantity': item_data['cantidad'],
         })
 
+    # Guardamos el carrito en el servidor para el webhook; a Stripe solo le
+    # pasamos el ID del pedido pendiente.
+    pendiente = PedidoPendiente.objects.create(usuario=request.user, carrito=carrito)
+
     try:
         checkout_session = stripe.checkout.Session.create(
             payment_method_types=['card'],
@@ -173,12 +284,14 @@ def crear_sesion_pago(request):
             success_url=request.build_absolute_uri('/pedido/exitoso/'),
             cancel_url=request.build_absolute_uri('/carrito/'),
             metadata={
-                'user_id': request.user.id,
-                'carrito': json.dumps(carrito) # Guardamos el carrito para el webhook
+                'pedido_pendiente_id': pendiente.id,
             }
         )
+        pendiente.id_sesion_pago = checkout_session.id
+        pendiente.save(update_fields=['id_sesion_pago'])
         return redirect(checkout_session.url, code=303)
     except Exception as e:
+        pendiente.delete()
         messages.error(request, f"Error al conectar con la pasarela de pago: {e}")
         return redirect('vista_carrito')
 
@@ -214,37 +327,67 @@ def stripe_webhook(request):
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
         
-        # Extraer metadatos
-        user_id = session.metadata['user_id']
-        carrito = json.loads(session.metadata['carrito'])
-        user = get_object_or_404(User, id=user_id)
-        
-        # Evitar crear pedidos duplicados si el webhook se envía varias veces
-        if Pedido.objects.filter(id_transaccion_pago=session.id).exists():
-            return HttpResponse(status=200)
-
-        # 1. Crear el objeto Pedido
-        pedido = Pedido.objects.create(
-            usuario=user,
-            total=session.amount_total / 100.0,
-            estado='En preparación',
-            id_transaccion_pago=session.id
-        )
-        
-        # 2. Crear los Detalles del Pedido y actualizar stock
-        for producto_id, item_data in carrito.items():
-            producto = get_object_or_404(Producto, id=producto_id)
-            cantidad = item_data['cantidad']
-            
-            DetallePedido.objects.create(
-                pedido=pedido,
-                producto=producto,
-                cantidad=cantidad,
-                precio_unitario=producto.precio
+        pendiente_id = session.metadata.get('pedido_pendiente_id')
+        if pendiente_id:
+            # Recuperar el carrito guardado y su usuario en una sola consulta.
+            # Si ya no existe es que este pago ya se procesó en un envío anterior.
+            pendiente = PedidoPendiente.objects.select_related('usuario').filter(id=pendiente_id).first()
+            if pendiente is None:
+                return HttpResponse(status=200)
+            carrito = pendiente.carrito
+            user = pendiente.usuario
+        else:
+            # Sesiones de pago creadas antes de PedidoPendiente: el carrito y
+            # el usuario venían directamente en los metadatos.
+            pendiente = None
+            carrito = json.loads(session.metadata['carrito'])
+            user = get_object_or_404(User, id=session.metadata['user_id'])
+
+        productos = obtener_productos_carrito(carrito)
+
+        # Todo el pedido se guarda o se descarta junto (pedido, detalles y stock).
+        with transaction.atomic():
+            # 1. Crear el objeto Pedido.
+            # Si el webhook se envía varias veces, la restricción única sobre
+            # id_transaccion_pago hace fallar el INSERT y no se duplica el pedido.
+            try:
+                with transaction.atomic():
+                    pedido = Pedido.objects.create(
+                        usuario=user,
+                        total=session.amount_total / 100.0,
+                        estado='En preparación',
+                        id_transaccion_pago=session.id
+                    )
+            except IntegrityError:
+                return HttpResponse(status=200)
+
+            # 2. Crear los Detalles del Pedido y actualizar stock
+            detalles = []
+            descuentos_stock = []
+            for producto_id, item_data in carrito.items():
+                producto = productos[int(producto_id)]
+                cantidad = item_data['cantidad']
+
+                detalles.append(DetallePedido(
+                    pedido=pedido,
+                    producto=producto,
+                    cantidad=cantidad,
+                    precio_unitario=producto.precio,
+                    subtotal=producto.precio * cantidad
+                ))
+                descuentos_stock.append(When(id=producto.id, then=Value(cantidad)))
+
+            DetallePedido.objects.bulk_create(detalles, batch_size=500)
+
+            # Actualizar stock con un solo UPDATE. Al restar con F() la base de
+            # datos hace la resta, así dos webhooks simultáneos no se pisan.
+            Producto.objects.filter(id__in=productos).update(
+                stock=F('stock') - Case(*descuentos_stock)
             )
-            # Actualizar stock
-            producto.stock -= cantidad
-            producto.save()
+
+            # El carrito ya se convirtió en pedido, no hace falta guardarlo más.
+            if pendiente is not None:
+                pendiente.delete()
         
         # 3. Enviar correos de confirmación
         # (Descomentar y configurar SMTP en settings.py para que funcione)
@@ -255,10 +398,17 @@ def stripe_webhook(request):
         #     recipient_list=[user.email],
         # )
 
-        # 4. Vaciar el carrito de la sesión
-        # Esto es un desafío porque el webhook no tiene acceso a la sesión del usuario.
+        # 4. Vaciar el carrito (cookie del navegador)
+        # Esto es un desafío porque el webhook no tiene acceso a las cookies del usuario.
         # Una estrategia es marcar el pedido como "pagado" y que la vista de "éxito"
         # vacíe el carrito si el último pedido del usuario está pagado.
+
+    elif event['type'] == 'checkout.session.expired':
+        # El usuario abandonó el pago y Stripe caducó la sesión: el pedido
+        # pendiente ya no se va a completar, así que se borra.
+        pendiente_id = event['data']['object'].metadata.get('pedido_pendiente_id')
+        if pendiente_id:
+            PedidoPendiente.objects.filter(id=pendiente_id).delete()
         
     return HttpResponse(status=200)
 
@@ -270,10 +420,17 @@ def stripe_webhook(request):
 @login_required
 def historial_pedidos(request):
     """
-    Muestra el historial de pedidos del usuario que ha iniciado sesión.
+    Muestra el historial de pedidos del usuario que ha iniciado sesión, paginado.
     """
-    pedidos = Pedido.objects.filter(usuario=request.user).order_by('-fecha_pedido')
+    # Los detalles y sus productos se traen en dos consultas extra en total,
+    # en lugar de una por cada pedido y por cada línea.
+    pedidos = Pedido.objects.filter(usuario=request.user).order_by('-fecha_pedido').prefetch_related(
+        Prefetch('detalles', queryset=DetallePedido.objects.select_related('producto'))
+    )
+    paginator = Paginator(pedidos, 25)
+    page_obj = paginator.get_page(request.GET.get('page'))
     context = {
-        'pedidos': pedidos
+        'pedidos': page_obj,
+        'page_obj': page_obj,
     }
     return render(request, 'tienda/historial.html', context)